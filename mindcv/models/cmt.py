@@ -6,7 +6,8 @@ import mindspore.nn as nn
 import mindspore.ops as ops
 
 from .helpers import _ntuple, load_pretrained
-from .layers import Dropout, DropPath, GlobalAvgPooling
+from .layers import DropPath, GlobalAvgPooling
+from .layers.compatibility import Dropout
 from .registry import register_model
 
 __all__ = [
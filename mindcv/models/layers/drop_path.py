@@ -4,9 +4,7 @@ Papers:
 Deep Networks with Stochastic Depth (https://arxiv.org/abs/1603.09382)
 """
 from mindspore import Tensor, nn, ops
-from mindspore.numpy import ones
-
-from .compatibility import Dropout
+from mindspore.common.seed import _get_graph_seed
 
 
 class DropPath(nn.Cell):
@@ -20,13 +18,18 @@ class DropPath(nn.Cell):
         super().__init__()
         self.keep_prob = 1.0 - drop_prob
         self.scale_by_keep = scale_by_keep
-        self.dropout = Dropout(p=drop_prob)
+        # seeded like nn.Dropout so that ms.set_seed keeps training reproducible
+        seed0, seed1 = _get_graph_seed(0, "uniform")
+        self.uniform = ops.UniformReal(seed=seed0, seed2=seed1)
 
     def construct(self, x: Tensor) -> Tensor:
         if self.keep_prob == 1.0 or not self.training:
             return x
         shape = (x.shape[0],) + (1,) * (x.ndim - 1)
-        random_tensor = self.dropout(ones(shape))
-        if not self.scale_by_keep:
-            random_tensor = ops.mul(random_tensor, self.keep_prob)
+        # per-sample Bernoulli(keep_prob) mask, broadcast over the remaining dims
+        random_tensor = ops.floor(self.keep_prob + self.uniform(shape))
+        # follow the input dtype (e.g. fp16 under AMP) so the multiply below needs no implicit cast
+        random_tensor = ops.cast(random_tensor, x.dtype)
+        if self.scale_by_keep:
+            random_tensor = ops.div(random_tensor, self.keep_prob)
         return x * random_tensor
@@ -8,7 +8,6 @@ from typing import Optional
 from mindspore import Tensor, nn, ops
 
 from ..helpers import make_divisible
-from .pooling import GlobalAvgPooling
 
 
 class SqueezeExcite(nn.Cell):
@@ -51,10 +50,9 @@ class SqueezeExcite(nn.Cell):
             kernel_size=1,
             has_bias=True,
         )
-        self.pool = GlobalAvgPooling(keep_dims=True)
 
     def construct(self, x: Tensor) -> Tensor:
-        x_se = self.pool(x)
+        x_se = ops.mean(x, axis=(2, 3), keep_dims=True)
         x_se = self.conv_reduce(x_se)
         if self.norm:
             x_se = self.bn(x_se)
@@ -99,10 +97,9 @@ class SqueezeExciteV2(nn.Cell):
             out_channels=in_channels,
             has_bias=True,
         )
-        self.pool = GlobalAvgPooling(keep_dims=False)
 
     def construct(self, x: Tensor) -> Tensor:
-        x_se = self.pool(x)
+        x_se = ops.mean(x, axis=(2, 3))
         x_se = self.conv_reduce(x_se)
         if self.norm:
             x_se = self.bn(x_se)
@@ -3,14 +3,14 @@ MindSpore implementation of `RegNet`.
 Refer to: Designing Network Design Spaces
 """
 
-import math
-
 import numpy as np
 
+import mindspore as ms
 import mindspore.common.initializer as init
-from mindspore import nn
+from mindspore import Tensor, nn, ops
 
 from .helpers import load_pretrained
+from .layers.identity import Identity
 from .layers.pooling import GlobalAvgPooling
 from .layers.squeeze_excite import SqueezeExcite
 from .registry import register_model
@@ -81,6 +81,10 @@ default_cfgs = {
 }
 
 
+# Stateless initializer shared by all convs: N(0, sqrt(2 / (k * k * w_out))).
+_CONV_INIT = init.HeNormal(mode="fan_out", nonlinearity="relu")
+
+
 def conv2d(w_in, w_out, k, *, stride=1, groups=1, bias=False):
     """Helper for building a conv2d layer."""
     assert k % 2 == 1, "Only odd size kernels supported to avoid padding issues."
@@ -97,9 +101,12 @@ def pool2d(_w_in, k, *, stride=1):
     """Helper for building a pool2d layer."""
     assert k % 2 == 1, "Only odd size kernels supported to avoid padding issues."
     padding = (k - 1) // 2
-    pad2d = nn.Pad(((0, 0), (0, 0), (padding, padding), (padding, padding)), mode="CONSTANT")
-    max_pool = nn.MaxPool2d(kernel_size=k, stride=stride, pad_mode="valid")
-    return nn.SequentialCell([pad2d, max_pool])
+    try:
+        return nn.MaxPool2d(kernel_size=k, stride=stride, pad_mode="pad", padding=padding)
+    except TypeError:  # MaxPool2d takes an explicit padding only on MindSpore >= 2.0
+        pad2d = nn.Pad(((0, 0), (0, 0), (padding, padding), (padding, padding)), mode="CONSTANT")
+        max_pool = nn.MaxPool2d(kernel_size=k, stride=stride, pad_mode="valid")
+        return nn.SequentialCell([pad2d, max_pool])
 
 
 def gap2d(keep_dims=False):
@@ -117,6 +124,27 @@ def activation():
     return nn.ReLU()
 
 
+def fuse_conv_bn(cell, conv_name, bn_name):
+    """Folds an eval-mode BatchNorm2d into the preceding conv2d of `cell` in place."""
+    conv, bn = getattr(cell, conv_name), getattr(cell, bn_name)
+    if not isinstance(bn, nn.BatchNorm2d):
+        return
+    t = bn.gamma / ops.sqrt(bn.moving_variance + bn.eps)
+    bias = bn.beta - bn.moving_mean * t
+    if conv.has_bias:
+        bias = bias + conv.bias * t
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                      pad_mode=conv.pad_mode, padding=conv.padding, dilation=conv.dilation, group=conv.group,
+                      has_bias=True)
+    fused.weight.set_data(conv.weight * ops.reshape(t, (-1, 1, 1, 1)))
+    fused.bias.set_data(bias)
+    # setattr only prefixes the attribute name, restore the full path of the replaced conv (e.g. "stem.conv.")
+    prefix = conv.weight.name[:-len("weight")]
+    setattr(cell, conv_name, fused)
+    fused.update_parameters_name(prefix)
+    setattr(cell, bn_name, Identity())
+
+
 class ResStemCifar(nn.Cell):
     """ResNet stem for CIFAR: 3x3, BN, AF."""
 
@@ -126,6 +154,9 @@ class ResStemCifar(nn.Cell):
         self.bn = norm2d(w_out)
         self.af = activation()
 
+    def fuse(self):
+        fuse_conv_bn(self, "conv", "bn")
+
     def construct(self, x):
         x = self.conv(x)
         x = self.bn(x)
@@ -143,6 +174,9 @@ class ResStem(nn.Cell):
         self.af = activation()
         self.pool = pool2d(w_out, 3, stride=2)
 
+    def fuse(self):
+        fuse_conv_bn(self, "conv", "bn")
+
     def construct(self, x):
         x = self.conv(x)
         x = self.bn(x)
@@ -160,6 +194,9 @@ class SimpleStem(nn.Cell):
         self.bn = norm2d(w_out)
         self.af = activation()
 
+    def fuse(self):
+        fuse_conv_bn(self, "conv", "bn")
+
     def construct(self, x):
         x = self.conv(x)
         x = self.bn(x)
@@ -179,6 +216,10 @@ class VanillaBlock(nn.Cell):
         self.b_bn = norm2d(w_out)
         self.b_af = activation()
 
+    def fuse(self):
+        fuse_conv_bn(self, "a", "a_bn")
+        fuse_conv_bn(self, "b", "b_bn")
+
     def construct(self, x):
         x = self.a(x)
         x = self.a_bn(x)
@@ -201,6 +242,10 @@ class BasicTransform(nn.Cell):
         self.b_bn = norm2d(w_out)
         self.b_bn.final_bn = True
 
+    def fuse(self):
+        fuse_conv_bn(self, "a", "a_bn")
+        fuse_conv_bn(self, "b", "b_bn")
+
     def construct(self, x):
         x = self.a(x)
         x = self.a_bn(x)
@@ -222,6 +267,10 @@ class ResBasicBlock(nn.Cell):
         self.f = BasicTransform(w_in, w_out, stride, params)
         self.af = activation()
 
+    def fuse(self):
+        if self.proj is not None:
+            fuse_conv_bn(self, "proj", "bn")
+
     def construct(self, x):
         x_p = self.bn(self.proj(x)) if self.proj is not None else x
         return self.af(x_p + self.f(x))
@@ -241,11 +290,16 @@ class BottleneckTransform(nn.Cell):
         self.b = conv2d(w_b, w_b, 3, stride=stride, groups=groups)
         self.b_bn = norm2d(w_b)
         self.b_af = activation()
-        self.se = SqueezeExcite(in_channels=w_b, rd_channels=w_se) if w_se else None
+        self.se = SqueezeExcite(in_channels=w_b, rd_channels=w_se, gate_layer=params["se_gate"]) if w_se else None
         self.c = conv2d(w_b, w_out, 1)
         self.c_bn = norm2d(w_out)
         self.c_bn.final_bn = True
 
+    def fuse(self):
+        fuse_conv_bn(self, "a", "a_bn")
+        fuse_conv_bn(self, "b", "b_bn")
+        fuse_conv_bn(self, "c", "c_bn")
+
     def construct(self, x):
         x = self.a(x)
         x = self.a_bn(x)
@@ -271,6 +325,10 @@ class ResBottleneckBlock(nn.Cell):
         self.f = BottleneckTransform(w_in, w_out, stride, params)
         self.af = activation()
 
+    def fuse(self):
+        if self.proj is not None:
+            fuse_conv_bn(self, "proj", "bn")
+
     def construct(self, x):
         x_p = self.bn(self.proj(x)) if self.proj is not None else x
         return self.af(x_p + self.f(x))
@@ -319,6 +377,10 @@ class AnyHead(nn.Cell):
         self.avg_pool = gap2d()
         self.fc = linear(w_in, num_classes, bias=True)
 
+    def fuse(self):
+        if self.head_width > 0:
+            fuse_conv_bn(self, "conv", "bn")
+
     def construct(self, x):
         x = self.af(self.bn(self.conv(x))) if self.head_width > 0 else x
         x = self.avg_pool(x)
@@ -373,7 +435,7 @@ class AnyNet(nn.Cell):
         }
 
     def __init__(self, depths, stem_type, stem_w, block_type, widths, strides, bot_muls, group_ws, head_w, num_classes,
-                 se_r, in_channels):
+                 se_r, in_channels, se_gate=nn.Sigmoid):
         super(AnyNet, self).__init__()
         p = AnyNet.anynet_get_params(depths, stem_type, stem_w, block_type, widths, strides, bot_muls, group_ws, head_w,
                                      num_classes, se_r)
@@ -384,7 +446,7 @@ class AnyNet(nn.Cell):
         keys = ["depths", "widths", "strides", "bot_muls", "group_ws"]
         self.stages = nn.CellList()
         for i, (d, w, s, b, g) in enumerate(zip(*[p[k] for k in keys])):
-            params = {"bot_mul": b, "group_w": g, "se_r": p["se_r"]}
+            params = {"bot_mul": b, "group_w": g, "se_r": p["se_r"], "se_gate": se_gate}
             stage = AnyStage(prev_w, w, s, d, block_fun, params)
             self.stages.append(stage)
             prev_w = w
@@ -395,16 +457,13 @@ class AnyNet(nn.Cell):
         """Initialize weights for cells."""
         for _, cell in self.cells_and_names():
             if isinstance(cell, nn.Conv2d):
-                fan_out = cell.kernel_size[0] * cell.kernel_size[1] * cell.out_channels
-                cell.weight.set_data(
-                    init.initializer(init.Normal(sigma=math.sqrt(2.0 / fan_out), mean=0.0),
-                                     cell.weight.shape, cell.weight.dtype))
+                cell.weight.set_data(init.initializer(_CONV_INIT, cell.weight.shape, cell.weight.dtype))
             elif isinstance(cell, nn.BatchNorm2d):
                 cell.gamma.set_data(init.initializer("ones", cell.gamma.shape, cell.gamma.dtype))
                 cell.beta.set_data(init.initializer("zeros", cell.beta.shape, cell.beta.dtype))
             elif isinstance(cell, nn.Dense):
-                cell.weight.set_data(
-                    init.initializer(init.Normal(sigma=0.01, mean=0.0), cell.weight.shape, cell.weight.dtype))
+                weight = np.random.normal(0.0, 0.01, size=cell.weight.shape)
+                cell.weight.set_data(Tensor(weight, cell.weight.dtype))
                 if cell.bias is not None:
                     cell.bias.set_data(init.initializer("zeros", cell.bias.shape, cell.bias.dtype))
 
@@ -414,6 +473,15 @@ class AnyNet(nn.Cell):
             x = module(x)
         return x
 
+    def forward_from_stage(self, x, stage_idx):
+        """Resumes the forward pass at `self.stages[stage_idx]`, e.g. from features cached by the caller
+        for multi-crop / TTA inference where the early stages are shared. `stage_idx` must be a constant."""
+        # index rather than slice: slicing the container re-registers (and renames) the stage parameters
+        for i in range(stage_idx, len(self.stages)):
+            x = self.stages[i](x)
+        x = self.forward_head(x)
+        return x
+
     def forward_head(self, x):
         x = self.head(x)
         return x
@@ -424,18 +492,33 @@ class AnyNet(nn.Cell):
         return x
 
 
+def _adjust_core(ws, bs, gs):
+    """Numeric core of `adjust_block_compatibility`, operating on NumPy arrays."""
+    vs = np.maximum(1, ws * bs).astype(int)
+    gs = np.minimum(gs, vs).astype(int)
+    ms = np.where(bs > 1, np.lcm(gs, bs.astype(int)), gs)
+    vs = np.maximum(ms, (np.round(vs / ms) * ms).astype(int))
+    ws = (vs / bs).astype(int)
+    return ws, bs, gs
+
+
 def adjust_block_compatibility(ws, bs, gs):
     """Adjusts the compatibility of widths, bottlenecks, and groups."""
+    ws, bs, gs = np.asarray(ws), np.asarray(bs), np.asarray(gs)
     assert len(ws) == len(bs) == len(gs)
-    assert all(w > 0 and b > 0 and g > 0 for w, b, g in zip(ws, bs, gs))
-    assert all(b < 1 or b % 1 == 0 for b in bs)
-    vs = [int(max(1, w * b)) for w, b in zip(ws, bs)]
-    gs = [int(min(g, v)) for g, v in zip(gs, vs)]
-    ms = [np.lcm(g, int(b)) if b > 1 else g for g, b in zip(gs, bs)]
-    vs = [max(m, int(round(v / m) * m)) for v, m in zip(vs, ms)]
-    ws = [int(v / b) for v, b in zip(vs, bs)]
-    assert all(w * b % g == 0 for w, b, g in zip(ws, bs, gs))
-    return ws, bs, gs
+    assert np.all((ws > 0) & (bs > 0) & (gs > 0))
+    assert np.all((bs < 1) | (bs % 1 == 0))
+    ws, bs, gs = _adjust_core(ws, bs, gs)
+    assert np.all(ws * bs % gs == 0)
+    return ws.tolist(), bs.tolist(), gs.tolist()
+
+
+def _quantize_widths(ws_cont, w_0, w_m, q):
+    """Snaps continuous per-block widths to w_0 * w_m^k, rounded to a multiple of q."""
+    ks = np.round(np.log(ws_cont / w_0) / np.log(w_m))
+    ws_all = w_0 * np.power(w_m, ks)
+    ws_all = np.round(np.divide(ws_all, q)).astype(int) * q
+    return ks, ws_all
 
 
 def generate_regnet(w_a, w_0, w_m, d, q=8):
@@ -444,9 +527,7 @@ def generate_regnet(w_a, w_0, w_m, d, q=8):
     # Generate continuous per-block ws
     ws_cont = np.arange(d) * w_a + w_0
     # Generate quantized per-block ws
-    ks = np.round(np.log(ws_cont / w_0) / np.log(w_m))
-    ws_all = w_0 * np.power(w_m, ks)
-    ws_all = np.round(np.divide(ws_all, q)).astype(int) * q
+    ks, ws_all = _quantize_widths(ws_cont, w_0, w_m, q)
     # Generate per stage ws and ds (assumes ws_all are sorted)
     ws, ds = np.unique(ws_all, return_counts=True)
     # Compute number of actual stages and total possible stages
@@ -459,9 +540,9 @@ def generate_regnet(w_a, w_0, w_m, d, q=8):
 def generate_regnet_full(w_a, w_0, w_m, d, stride, bot_mul, group_w):
     """Generates per stage ws, ds, gs, bs, and ss from RegNet cfg."""
     ws, ds = generate_regnet(w_a, w_0, w_m, d)[0:2]
-    ss = [stride for _ in ws]
-    bs = [bot_mul for _ in ws]
-    gs = [group_w for _ in ws]
+    ss = [stride] * len(ws)
+    bs = [bot_mul] * len(ws)
+    gs = [group_w] * len(ws)
     ws, bs, gs = adjust_block_compatibility(ws, bs, gs)
     return ws, ds, ss, bs, gs
 
@@ -469,6 +550,11 @@ def generate_regnet_full(w_a, w_0, w_m, d, stride, bot_mul, group_w):
 class RegNet(AnyNet):
     r"""RegNet model class, based on
     `"Designing Network Design Spaces" <https://arxiv.org/abs/2003.13678>`_
+
+    Set `enable_graph_kernel=True` to turn on MindSpore graph kernel fusion, which collapses the
+    conv -> bn -> relu and add -> relu tails of the residual blocks into fused kernels in GRAPH_MODE.
+    `se_gate` selects the SE gate of RegNetY; `nn.HSigmoid` avoids the exp of the default sigmoid,
+    but the pretrained weights were trained with the sigmoid gate.
     """
 
     @staticmethod
@@ -491,12 +577,29 @@ class RegNet(AnyNet):
         }
 
     def __init__(self, w_a, w_0, w_m, d, group_w, stride=2, bot_mul=1.0, stem_type="simple_stem_in", stem_w=32,
-                 block_type="res_bottleneck_block", head_w=0, num_classes=1000, se_r=0.0, in_channels=3):
+                 block_type="res_bottleneck_block", head_w=0, num_classes=1000, se_r=0.0, in_channels=3,
+                 enable_graph_kernel=False, se_gate=nn.Sigmoid):
+        if enable_graph_kernel:
+            ms.set_context(enable_graph_kernel=True)
         params = RegNet.regnet_get_params(w_a, w_0, w_m, d, stride, bot_mul, group_w, stem_type, stem_w, block_type,
                                           head_w, num_classes, se_r)
         super(RegNet, self).__init__(params["depths"], params["stem_type"], params["stem_w"], params["block_type"],
                                      params["widths"], params["strides"], params["bot_muls"], params["group_ws"],
-                                     params["head_w"], params["num_classes"], params["se_r"], in_channels)
+                                     params["head_w"], params["num_classes"], params["se_r"], in_channels,
+                                     se_gate)
+
+    def export_for_inference(self):
+        """Folds every BatchNorm2d into its preceding conv2d. The model is switched to eval mode first.
+        Call it before the model is compiled, a graph compiled earlier would keep running the unfused cells."""
+        if getattr(self, "compile_cache", None):
+            raise RuntimeError("export_for_inference() must be called before the network is compiled, "
+                               "the compiled graph would keep the unfused conv and BatchNorm cells.")
+        self.set_train(False)
+        cells = [cell for _, cell in self.cells_and_names()]
+        for cell in cells:
+            if hasattr(cell, "fuse"):
+                cell.fuse()
+        return self
 
 
 @register_model
@@ -17,6 +17,11 @@ from .layers.drop_path import DropPath
 from .layers.identity import Identity
 from .registry import register_model
 
+try:
+    from mindspore.ops.operations.nn_ops import FlashAttentionScore
+except ImportError:
+    FlashAttentionScore = None
+
 __all__ = [
     "VOLO",
     "volo_d1",
@@ -51,15 +56,69 @@ default_cfgs = {
 }
 
 
+def _scale_dense(dense, scale, num_rows=None) -> None:
+    """Multiply the first `num_rows` output rows (all rows if None) of a Dense layer by `scale` in place."""
+    mult = np.ones(dense.weight.shape[0], np.float32)
+    mult[:num_rows] = scale
+    mult = Tensor(mult, dense.weight.dtype)
+    dense.weight.set_data(dense.weight * ops.reshape(mult, (-1, 1)))
+    if dense.bias is not None:
+        dense.bias.set_data(dense.bias * mult)
+
+
+def _trunc_normal(shape, sigma, bound=2.0) -> np.ndarray:
+    """Sample N(0, sigma^2) truncated to [-bound, bound], redrawing the out-of-range values. The absolute bound
+    matches `init.TruncatedNormal(sigma)`, which is still used for `pos_embed` and `cls_token`.
+    The generator is seeded from the global NumPy state so `np.random.seed` keeps runs reproducible."""
+    rng = np.random.default_rng(np.random.randint(2**31))
+    limit = bound / sigma  # bound in standard-normal units
+    values = rng.standard_normal(shape, dtype=np.float32)
+    outside = np.abs(values) > limit
+    while outside.any():
+        values[outside] = rng.standard_normal(int(outside.sum()), dtype=np.float32)
+        outside = np.abs(values) > limit
+    return values * sigma
+
+
+def _flash_attention(num_heads, scale, attn_drop, use_flash_attention):
+    """FlashAttentionScore primitive for B,heads,N,d inputs, or None if disabled or unavailable.
+    Attention dropout is not routed through the fused op, so a positive `attn_drop` keeps the explicit path."""
+    if not use_flash_attention or FlashAttentionScore is None or attn_drop > 0.0:
+        return None
+    # the primitive imports on every build but only has an Ascend kernel
+    if ms.get_context("device_target") != "Ascend":
+        return None
+    return FlashAttentionScore(head_num=num_heads, scale_value=scale, input_layout="BNSD")
+
+
+def _run_flash_attention(flash_attention, q, k, v) -> Tensor:
+    """Fused attention on B,heads,N,d inputs; the kernel only takes float16 / bfloat16, so float32 is cast."""
+    dtype = q.dtype
+    if dtype == mstype.float32:
+        q, k, v = ops.cast(q, mstype.float16), ops.cast(k, mstype.float16), ops.cast(v, mstype.float16)
+    x = flash_attention(q, k, v)[3]
+    if x.dtype != dtype:
+        x = ops.cast(x, dtype)
+    return x
+
+
+def _dropout(p) -> nn.Cell:
+    """Dropout with probability `p`, or an Identity when `p` is 0 so no kernel is emitted."""
+    return Dropout(p=p) if p > 0.0 else Identity()
+
+
 class Fold(nn.Cell):
-    def __init__(self, channels, output_size, kernel_size, dilation=1, padding=0, stride=1) -> None:
-        """Alternative implementation of fold layer via transposed convolution.
+    def __init__(self, channels, kernel_size, dilation=1, padding=0, stride=1, use_col2im=None) -> None:
+        """Fold layer backed by the native col2im kernel, or by a transposed convolution on older MindSpore.
         All parameters are same as `"torch.nn.Fold" <https://pytorch.org/docs/stable/generated/torch.nn.Fold.html>`_,
-        except for the additional `channels` parameter. We need `channels` to calculate the pre-allocated memory
-        size of the convolution kernel.
+        except for the additional `channels` parameter and `output_size`, which is given to `construct` so that
+        one instance can be built once and reused for every input size. We need `channels` to calculate the
+        pre-allocated memory size of the convolution kernel.
         :param channels: same as the `C` in the document of `"torch.nn.Fold"
                          <https://pytorch.org/docs/stable/generated/torch.nn.Fold.html>`_
         :type channels: int
+        :param use_col2im: whether to use the native col2im kernel, auto-detected if None
+        :type use_col2im: bool
         """
         super().__init__()
 
@@ -67,37 +126,34 @@ class Fold(nn.Cell):
             if isinstance(a, int):
                 return (a, a)
             return a
-        self.output_size, self.kernel_size, self.dilation, self.padding, self.stride = map(
-                                    int2tuple, (output_size, kernel_size, dilation, padding, stride))
-        self.h = int((self.output_size[0] + 2 * self.padding[0] - self.dilation[0] * (self.kernel_size[0] - 1) - 1)
-                     / self.stride[0] + 1)
-        self.w = int((self.output_size[1] + 2 * self.padding[1] - self.dilation[1] * (self.kernel_size[1] - 1) - 1)
-                     / self.stride[1] + 1)
+        self.kernel_size, self.dilation, self.padding, self.stride = map(
+                                    int2tuple, (kernel_size, dilation, padding, stride))
         self.k = self.kernel_size[0] * self.kernel_size[1]
         self.c = channels
         self.ck = self.c * self.k
-        init_weight = np.zeros((self.ck, 1, self.kernel_size[0], self.kernel_size[1]))
-        for i in range(self.ck):
-            xy = i % self.k
-            x = xy // self.kernel_size[1]
-            y = xy % self.kernel_size[1]
-            init_weight[i, 0, x, y] = 1
-
-        self.weight = ms.Tensor(init_weight, ms.float16)
-        self.conv_transpose2d = ops.Conv2DTranspose(
-                                    self.ck, self.kernel_size, pad_mode="pad",
-                                    pad=(self.padding[0], self.padding[0], self.padding[1], self.padding[1]),
-                                    stride=stride, dilation=dilation, group=self.c)
-
-    def construct(self, x: Tensor) -> Tensor:
+        # use the native col2im kernel where available (MindSpore >= 2.0), the transposed convolution otherwise
+        self.use_col2im = hasattr(ops, "fold") if use_col2im is None else use_col2im
+        if not self.use_col2im:
+            # one-hot kernel: output channel i picks position i % k of its k x k window
+            one_hot = ops.reshape(ops.eye(self.k, self.k, ms.float16), (self.k, 1, *self.kernel_size))
+            self.weight = ops.tile(one_hot, (self.c, 1, 1, 1))
+            self.conv_transpose2d = ops.Conv2DTranspose(
+                                        self.ck, self.kernel_size, pad_mode="pad",
+                                        pad=(self.padding[0], self.padding[0], self.padding[1], self.padding[1]),
+                                        stride=stride, dilation=dilation, group=self.c)
+
+    def construct(self, x: Tensor, output_size) -> Tensor:
         b, ck, hw = x.shape
-        # todo: assert is not allowed in construct, how to check the shape?
-        # assert ck == self.c * self.k
-        # assert l == self.h * self.w
-        # print("construct-b", b, "construct-ck", ck, "construct-l", l)
-        # print("self.h", self.h, "self.w", self.w)
-        x = ops.reshape(x, (b, ck, self.h, self.w))
-        out = self.conv_transpose2d(x, self.weight, (b, self.c, self.output_size[0], self.output_size[1]))
+        if self.use_col2im:
+            x = ops.reshape(x, (b, self.c, self.k, hw))
+            return ops.fold(x, Tensor(output_size, mstype.int32), self.kernel_size,
+                            self.dilation, self.padding, self.stride)
+        (kh, kw), (dh, dw), (ph, pw), (sh, sw) = self.kernel_size, self.dilation, self.padding, self.stride
+        h = (output_size[0] + 2 * ph - dh * (kh - 1) - 1) // sh + 1
+        w = (output_size[1] + 2 * pw - dw * (kw - 1) - 1) // sw + 1
+        x = ops.reshape(x, (b, ck, h, w))
+        weight = self.weight if self.weight.dtype == x.dtype else ops.cast(self.weight, x.dtype)
+        out = self.conv_transpose2d(x, weight, (b, self.c, output_size[0], output_size[1]))
 
         return out
 
@@ -108,6 +164,7 @@ class OutlookAttention(nn.Cell):
     --dim: hidden dim
     --num_heads: number of heads
     --kernel_size: kernel size in each window for outlook attention
+    --input_resolution: optional (H, W) of the input, lets the window grid be computed once
     return: token features after outlook attention
     """
 
@@ -122,6 +179,7 @@ class OutlookAttention(nn.Cell):
         qk_scale=None,
         attn_drop=0.0,
         proj_drop=0.0,
+        input_resolution=None,
     ) -> None:
         super().__init__()
         head_dim = dim // num_heads
@@ -130,46 +188,114 @@ class OutlookAttention(nn.Cell):
         self.padding = padding
         self.stride = stride
         self.scale = qk_scale or head_dim**-0.5
+        self.scale_folded = False
 
         self.v = nn.Dense(dim, dim, has_bias=qkv_bias)
         self.attn = nn.Dense(dim, kernel_size**4 * num_heads)
 
-        self.attn_drop = Dropout(p=attn_drop)
+        self.attn_drop = _dropout(attn_drop)
         self.proj = nn.Dense(dim, dim)
-        self.proj_drop = Dropout(p=proj_drop)
+        self.proj_drop = _dropout(proj_drop)
 
+        # with stride 1 and centred padding, SAME padding of the unfold equals the explicit zero pad
+        self.unfold_same = stride == 1 and kernel_size % 2 == 1 and padding == kernel_size // 2
         self.unfold = nn.Unfold(ksizes=[1, kernel_size, kernel_size, 1], strides=[1, stride, stride, 1],
-                                rates=[1, 1, 1, 1])
-        self.pool = nn.AvgPool2d(kernel_size=stride, stride=stride)
+                                rates=[1, 1, 1, 1], padding="same" if self.unfold_same else "valid")
+        self.fold = Fold(dim, kernel_size, padding=padding, stride=stride)
         self.softmax = nn.Softmax(axis=-1)
         self.batch_mat_mul = ops.BatchMatMul()
+        # windows do not overlap, so unfold / fold reduce to reshape + transpose
+        self.non_overlap = stride == kernel_size
+        self.input_resolution = tuple(input_resolution) if input_resolution is not None else None
+        self.window_grid = None
+        if self.input_resolution is not None:
+            self.window_grid = self.get_window_grid(*self.input_resolution)
+
+    def get_window_grid(self, H: int, W: int):
+        """Number of windows along H and W, and whether the non-overlapping fast path applies."""
+        h = int((H - 1) / self.stride + 1)
+        w = int((W - 1) / self.stride + 1)
+        non_overlap = self.non_overlap and (H + 2 * self.padding == h * self.kernel_size
+                                            and W + 2 * self.padding == w * self.kernel_size)
+        return h, w, non_overlap
+
+    def fold_scale(self) -> None:
+        """Fold `scale` into the `attn` projection, see `VOLO.fold_attention_scale`."""
+        if not self.scale_folded:
+            _scale_dense(self.attn, self.scale)
+            self.scale_folded = True
+
+    def pool(self, x: Tensor) -> Tensor:
+        """AvgPool2d(stride, stride) on B,H,W,C tokens as a reshape + mean, so no NCHW round trip is needed."""
+        B, H, W, C = x.shape
+        s = self.stride
+        if s == 1:
+            return x
+        h, w = H // s, W // s
+        if H != h * s or W != w * s:
+            x = x[:, :h * s, :w * s]
+        x = ops.reshape(x, (B, h, s, w, s, C))
+        return ops.mean(x, axis=(2, 4))
+
+    def unfold_non_overlap(self, v: Tensor, h: int, w: int) -> Tensor:
+        """B,H,W,C -> B,H,N,kxk,C/H, valid when the padded input is tiled exactly by the windows."""
+        B, _, _, C = v.shape
+        k, p = self.kernel_size, self.padding
+        if p > 0:
+            v = ops.pad(v, (0, 0, p, p, p, p))
+        v = ops.reshape(v, (B, h, k, w, k, self.num_heads, C // self.num_heads))
+        v = ops.transpose(v, (0, 5, 1, 3, 2, 4, 6))
+        return ops.reshape(v, (B, self.num_heads, h * w, k * k, C // self.num_heads))
+
+    def fold_non_overlap(self, x: Tensor, H: int, W: int, h: int, w: int) -> Tensor:
+        """B,H,N,kxk,C/H -> B,H,W,C, the inverse of `unfold_non_overlap`."""
+        B, C = x.shape[0], self.num_heads * x.shape[-1]
+        k, p = self.kernel_size, self.padding
+        x = ops.reshape(x, (B, self.num_heads, h, w, k, k, C // self.num_heads))
+        x = ops.transpose(x, (0, 2, 4, 3, 5, 1, 6))
+        x = ops.reshape(x, (B, h * k, w * k, C))
+        if p > 0:
+            x = x[:, p:p + H, p:p + W]
+        return x
 
     def construct(self, x: Tensor) -> Tensor:
         B, H, W, C = x.shape
 
-        v = ops.transpose(self.v(x), (0, 3, 1, 2))  # B, C, H, W
-
-        h = int((H - 1) / self.stride + 1)
-        w = int((W - 1) / self.stride + 1)
-        v = ops.pad(v, (1, 1, 1, 1))
-        v = self.unfold(v)
-        v = ops.reshape(v, (B, self.num_heads, C // self.num_heads, self.kernel_size * self.kernel_size, h * w))
-        v = ops.transpose(v, (0, 1, 4, 3, 2))  # B,H,N,kxk,C/H
-
-        attn = self.pool(ops.transpose(x, (0, 3, 1, 2)))
-        attn = ops.transpose(attn, (0, 2, 3, 1))
-        attn = ops.reshape(self.attn(attn), (B, h * w, self.num_heads, self.kernel_size * self.kernel_size,
+        if (H, W) == self.input_resolution:
+            h, w, non_overlap = self.window_grid
+        else:
+            h, w, non_overlap = self.get_window_grid(H, W)
+        if non_overlap:
+            v = self.unfold_non_overlap(self.v(x), h, w)
+        else:
+            v = ops.transpose(self.v(x), (0, 3, 1, 2))  # B, C, H, W
+            if not self.unfold_same and self.padding > 0:
+                v = ops.pad(v, (self.padding, self.padding, self.padding, self.padding))
+            v = self.unfold(v)
+            v = ops.reshape(v, (B, self.num_heads, C // self.num_heads, self.kernel_size * self.kernel_size, h * w))
+            v = ops.transpose(v, (0, 1, 4, 3, 2))  # B,H,N,kxk,C/H
+
+        attn = ops.reshape(self.attn(self.pool(x)), (B, h * w, self.num_heads, self.kernel_size * self.kernel_size,
                            self.kernel_size * self.kernel_size))
         attn = ops.transpose(attn, (0, 2, 1, 3, 4))  # B,H,N,kxk,kxk
-        attn = attn * self.scale
+        if not self.scale_folded:
+            attn = attn * self.scale
         attn = self.softmax(attn)
         attn = self.attn_drop(attn)
-
-        x = ops.transpose(self.batch_mat_mul(attn, v), (0, 1, 4, 3, 2))
-        x = ops.reshape(x, (B, C * self.kernel_size * self.kernel_size, h * w))
-        fold = Fold(C, (H, W), self.kernel_size, padding=self.padding, stride=self.stride)
-        x = fold(x)
-        x = self.proj(ops.transpose(x, (0, 2, 3, 1)))
+        if attn.dtype != v.dtype:  # softmax is kept in float32 under a reduced block dtype
+            attn = ops.cast(attn, v.dtype)
+
+        # flatten the leading dims so BatchMatMul runs as a single 3-D batched GEMM
+        kk, head_dim = self.kernel_size * self.kernel_size, C // self.num_heads
+        x = self.batch_mat_mul(ops.reshape(attn, (-1, kk, kk)), ops.reshape(v, (-1, kk, head_dim)))
+        x = ops.reshape(x, (B, self.num_heads, h * w, kk, head_dim))
+        if non_overlap:
+            x = self.fold_non_overlap(x, H, W, h, w)
+        else:
+            x = ops.transpose(x, (0, 1, 4, 3, 2))
+            x = ops.reshape(x, (B, C * self.kernel_size * self.kernel_size, h * w))
+            x = ops.transpose(self.fold(x, (H, W)), (0, 2, 3, 1))
+        x = self.proj(x)
         x = self.proj_drop(x)
 
         return x
@@ -199,16 +325,16 @@ class Outlooker(nn.Cell):
         norm_layer=nn.LayerNorm,
         qkv_bias=False,
         qk_scale=None,
+        input_resolution=None,
     ) -> None:
         super().__init__()
         self.norm1 = norm_layer([dim])
         self.attn = OutlookAttention(dim, num_heads, kernel_size=kernel_size,
                                      padding=padding, stride=stride,
                                      qkv_bias=qkv_bias, qk_scale=qk_scale,
-                                     attn_drop=attn_drop)
+                                     attn_drop=attn_drop, input_resolution=input_resolution)
 
-        self.drop_path = DropPath(
-            drop_path) if drop_path > 0.0 else Identity()
+        self.drop_path = DropPath(drop_path) if drop_path > 0.0 else Identity()
 
         self.norm2 = norm_layer([dim])
         mlp_hidden_dim = int(dim * mlp_ratio)
@@ -239,7 +365,7 @@ class Mlp(nn.Cell):
         self.fc1 = nn.Dense(in_features, hidden_features)
         self.act = act_layer()
         self.fc2 = nn.Dense(hidden_features, out_features)
-        self.drop = Dropout(p=drop)
+        self.drop = _dropout(drop)
 
     def construct(self, x: Tensor) -> Tensor:
         x = self.fc1(x)
@@ -261,19 +387,30 @@ class Attention(nn.Cell):
         qk_scale=None,
         attn_drop=0.0,
         proj_drop=0.0,
+        use_flash_attention=False,
     ) -> None:
         super().__init__()
         self.num_heads = num_heads
         head_dim = dim // num_heads
         self.scale = qk_scale or head_dim**-0.5
+        self.scale_folded = False
 
         self.qkv = nn.Dense(dim, dim * 3, has_bias=qkv_bias)
-        self.attn_drop = Dropout(p=attn_drop)
+        self.attn_drop = _dropout(attn_drop)
         self.proj = nn.Dense(dim, dim)
-        self.proj_drop = Dropout(p=proj_drop)
+        self.proj_drop = _dropout(proj_drop)
         self.softmax = nn.Softmax(axis=-1)
         self.batch_mat_mul_transpose = ops.BatchMatMul(transpose_b=True)
         self.batch_mat_mul = ops.BatchMatMul()
+        self.flash_attention = _flash_attention(num_heads, self.scale, attn_drop, use_flash_attention)
+
+    def fold_scale(self) -> None:
+        """Fold `scale` into the q rows of the `qkv` projection, see `VOLO.fold_attention_scale`."""
+        if not self.scale_folded:
+            _scale_dense(self.qkv, self.scale, self.qkv.weight.shape[0] // 3)
+            if self.flash_attention is not None:
+                self.flash_attention = _flash_attention(self.num_heads, 1.0, 0.0, True)
+            self.scale_folded = True
 
     def construct(self, x: Tensor) -> Tensor:
         B, H, W, C = x.shape
@@ -281,13 +418,22 @@ class Attention(nn.Cell):
         qkv = self.qkv(x)
         qkv = ops.reshape(qkv, (B, H * W, 3, self.num_heads, C // self.num_heads))
         qkv = ops.transpose(qkv, (2, 0, 3, 1, 4))
-        q, k, v = qkv[0], qkv[1], qkv[2]
-
-        attn = self.batch_mat_mul_transpose(q, k) * self.scale
-        attn = self.softmax(attn)
-        attn = self.attn_drop(attn)
-
-        x = ops.transpose(self.batch_mat_mul(attn, v), (0, 2, 1, 3))
+        if self.flash_attention is not None:
+            x = _run_flash_attention(self.flash_attention, qkv[0], qkv[1], qkv[2])
+        else:
+            qkv = ops.reshape(qkv, (3, B * self.num_heads, H * W, C // self.num_heads))  # 3-D batched GEMMs
+            q, k, v = qkv[0], qkv[1], qkv[2]
+
+            attn = self.batch_mat_mul_transpose(q, k)
+            if not self.scale_folded:
+                attn = attn * self.scale
+            attn = self.softmax(attn)
+            attn = self.attn_drop(attn)
+            if attn.dtype != v.dtype:  # softmax is kept in float32 under a reduced block dtype
+                attn = ops.cast(attn, v.dtype)
+
+            x = ops.reshape(self.batch_mat_mul(attn, v), (B, self.num_heads, H * W, C // self.num_heads))
+        x = ops.transpose(x, (0, 2, 1, 3))
         x = ops.reshape(x, (B, H, W, C))
         x = self.proj(x)
         x = self.proj_drop(x)
@@ -310,15 +456,16 @@ class Transformer(nn.Cell):
         drop_path=0.0,
         act_layer=nn.GELU,
         norm_layer=nn.LayerNorm,
+        use_flash_attention=False,
     ) -> None:
         super().__init__()
         self.norm1 = norm_layer([dim])
         self.attn = Attention(dim, num_heads=num_heads, qkv_bias=qkv_bias,
-                              qk_scale=qk_scale, attn_drop=attn_drop)
+                              qk_scale=qk_scale, attn_drop=attn_drop,
+                              use_flash_attention=use_flash_attention)
 
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
-        self.drop_path = DropPath(
-            drop_path) if drop_path > 0.0 else Identity()
+        self.drop_path = DropPath(drop_path) if drop_path > 0.0 else Identity()
 
         self.norm2 = norm_layer([dim])
         mlp_hidden_dim = int(dim * mlp_ratio)
@@ -346,6 +493,7 @@ class ClassAttention(nn.Cell):
         qk_scale=None,
         attn_drop=0.0,
         proj_drop=0.0,
+        use_flash_attention=False,
     ) -> None:
         super().__init__()
         self.num_heads = num_heads
@@ -355,15 +503,25 @@ class ClassAttention(nn.Cell):
             head_dim = dim // num_heads
             self.head_dim = head_dim
         self.scale = qk_scale or head_dim**-0.5
+        self.scale_folded = False
 
         self.kv = nn.Dense(dim, self.head_dim * self.num_heads * 2, has_bias=qkv_bias)
         self.q = nn.Dense(dim, self.head_dim * self.num_heads, has_bias=qkv_bias)
-        self.attn_drop = Dropout(p=attn_drop)
+        self.attn_drop = _dropout(attn_drop)
         self.proj = nn.Dense(self.head_dim * self.num_heads, dim)
-        self.proj_drop = Dropout(p=proj_drop)
+        self.proj_drop = _dropout(proj_drop)
         self.batch_mat_mul_transpose = ops.BatchMatMul(transpose_b=True)
         self.batch_mat_mul = ops.BatchMatMul()
         self.softmax = nn.Softmax(axis=-1)
+        self.flash_attention = _flash_attention(num_heads, self.scale, attn_drop, use_flash_attention)
+
+    def fold_scale(self) -> None:
+        """Fold `scale` into the `q` projection, see `VOLO.fold_attention_scale`."""
+        if not self.scale_folded:
+            _scale_dense(self.q, self.scale)
+            if self.flash_attention is not None:
+                self.flash_attention = _flash_attention(self.num_heads, 1.0, 0.0, True)
+            self.scale_folded = True
 
     def construct(self, x: Tensor) -> Tensor:
         B, N, C = x.shape
@@ -372,14 +530,24 @@ class ClassAttention(nn.Cell):
         kv = ops.reshape(kv, (B, N, 2, self.num_heads,
                          self.head_dim))
         kv = ops.transpose(kv, (2, 0, 3, 1, 4))
-        k, v = kv[0], kv[1]
         q = self.q(x[:, :1, :])
-        q = ops.reshape(q, (B, self.num_heads, 1, self.head_dim))
-        attn = self.batch_mat_mul_transpose(q * self.scale, k)
-        attn = self.softmax(attn)
-        attn = self.attn_drop(attn)
-
-        cls_embed = ops.transpose(self.batch_mat_mul(attn, v), (0, 2, 1, 3))
+        if self.flash_attention is not None:
+            q = ops.reshape(q, (B, self.num_heads, 1, self.head_dim))
+            cls_embed = _run_flash_attention(self.flash_attention, q, kv[0], kv[1])
+        else:
+            kv = ops.reshape(kv, (2, B * self.num_heads, N, self.head_dim))  # 3-D batched GEMMs
+            k, v = kv[0], kv[1]
+            q = ops.reshape(q, (B * self.num_heads, 1, self.head_dim))
+            if not self.scale_folded:
+                q = q * self.scale
+            attn = self.batch_mat_mul_transpose(q, k)
+            attn = self.softmax(attn)
+            attn = self.attn_drop(attn)
+            if attn.dtype != v.dtype:  # softmax is kept in float32 under a reduced block dtype
+                attn = ops.cast(attn, v.dtype)
+            cls_embed = self.batch_mat_mul(attn, v)
+
+        # a single query token, so heads can be merged back without a transpose
         cls_embed = ops.reshape(cls_embed, (B, 1, self.head_dim * self.num_heads))
         cls_embed = self.proj(cls_embed)
         cls_embed = self.proj_drop(cls_embed)
@@ -405,15 +573,16 @@ class ClassBlock(nn.Cell):
         drop_path=0.0,
         act_layer=nn.GELU,
         norm_layer=nn.LayerNorm,
+        use_flash_attention=False,
     ) -> None:
         super().__init__()
         self.norm1 = norm_layer([dim])
         self.attn = ClassAttention(
             dim, num_heads=num_heads, head_dim=head_dim, qkv_bias=qkv_bias,
-            qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop)
+            qk_scale=qk_scale, attn_drop=attn_drop, proj_drop=drop,
+            use_flash_attention=use_flash_attention)
         # NOTE: drop path for stochastic depth
-        self.drop_path = DropPath(
-            drop_path) if drop_path > 0.0 else Identity()
+        self.drop_path = DropPath(drop_path) if drop_path > 0.0 else Identity()
         self.norm2 = norm_layer([dim])
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim,
@@ -421,10 +590,15 @@ class ClassBlock(nn.Cell):
                        act_layer=act_layer,
                        drop=drop)
 
-    def construct(self, x: Tensor) -> Tensor:
+    def forward_cls_embed(self, x: Tensor) -> Tensor:
+        """Return only the updated class token, B,1,C."""
         cls_embed = x[:, :1]
         cls_embed = cls_embed + self.drop_path(self.attn(self.norm1(x)))
         cls_embed = cls_embed + self.drop_path(self.mlp(self.norm2(cls_embed)))
+        return cls_embed
+
+    def construct(self, x: Tensor) -> Tensor:
+        cls_embed = self.forward_cls_embed(x)
         x = ops.concat([cls_embed, x[:, 1:]], 1)
         return x
 
@@ -504,19 +678,19 @@ class Downsample(nn.Cell):
 
 def outlooker_blocks(block_fn, index, dim, layers, num_heads=1, kernel_size=3,
                      padding=1, stride=1, mlp_ratio=3., qkv_bias=False, qk_scale=None,
-                     attn_drop=0.0, drop_path_rate=0.0, **kwargs) -> nn.SequentialCell:
+                     attn_drop=0.0, drop_path_rates=None, input_resolution=None, **kwargs) -> nn.SequentialCell:
     """
     generate outlooker layer in stage1
+    --drop_path_rates: drop path rate of each block in this stage, all 0 if None
     return: outlooker layers
     """
     blocks = []
     for block_idx in range(layers[index]):
-        block_dpr = drop_path_rate * (block_idx +
-                                      sum(layers[:index])) / (sum(layers) - 1)
+        block_dpr = drop_path_rates[block_idx] if drop_path_rates is not None else 0.0
         blocks.append(block_fn(dim, kernel_size=kernel_size, padding=padding,
                                stride=stride, num_heads=num_heads, mlp_ratio=mlp_ratio,
                                qkv_bias=qkv_bias, qk_scale=qk_scale, attn_drop=attn_drop,
-                               drop_path=block_dpr))
+                               drop_path=block_dpr, input_resolution=input_resolution))
 
     blocks = nn.SequentialCell(*blocks)
 
@@ -525,22 +699,23 @@ def outlooker_blocks(block_fn, index, dim, layers, num_heads=1, kernel_size=3,
 
 def transformer_blocks(block_fn, index, dim, layers, num_heads, mlp_ratio=3.,
                        qkv_bias=False, qk_scale=None, attn_drop=0,
-                       drop_path_rate=0.0, **kwargs) -> nn.SequentialCell:
+                       drop_path_rates=None, use_flash_attention=False, **kwargs) -> nn.SequentialCell:
     """
     generate transformer layers in stage2
+    --drop_path_rates: drop path rate of each block in this stage, all 0 if None
     return: transformer layers
     """
     blocks = []
     for block_idx in range(layers[index]):
-        block_dpr = drop_path_rate * (block_idx +
-                                      sum(layers[:index])) / (sum(layers) - 1)
+        block_dpr = drop_path_rates[block_idx] if drop_path_rates is not None else 0.0
         blocks.append(
             block_fn(dim, num_heads,
                      mlp_ratio=mlp_ratio,
                      qkv_bias=qkv_bias,
                      qk_scale=qk_scale,
                      attn_drop=attn_drop,
-                     drop_path=block_dpr))
+                     drop_path=block_dpr,
+                     use_flash_attention=use_flash_attention))
 
     blocks = nn.SequentialCell(*blocks)
 
@@ -571,6 +746,10 @@ class VOLO(nn.Cell):
     --pooling_scale: pooling_scale=2 means we downsample 2x
     --out_kernel, --out_stride, --out_padding: kerner size,
                                                stride, and padding for outlook attention
+    --dtype: compute dtype of the attention and mlp of every block, e.g. mstype.float16;
+             LayerNorm, softmax and the residual stream stay in float32
+    --use_flash_attention: run transformer and class attention through the fused FlashAttentionScore
+                           kernel where MindSpore provides it (Ascend), and attn_drop_rate is 0
     """
     def __init__(
         self,
@@ -599,6 +778,8 @@ class VOLO(nn.Cell):
         out_kernel=3,
         out_stride=2,
         out_padding=1,
+        dtype=mstype.float32,
+        use_flash_attention=False,
     ) -> None:
 
         super().__init__()
@@ -612,10 +793,13 @@ class VOLO(nn.Cell):
                       img_size // patch_size // pooling_scale,
                       embed_dims[-1]), mstype.float32))
 
-        self.pos_drop = Dropout(p=drop_rate)
+        self.pos_drop = _dropout(drop_rate)
 
         # set the main block in network
         network = []
+        resolution = img_size // patch_size  # token grid size entering the current stage
+        # stochastic depth decay rule over all blocks, split per stage
+        dpr = np.split(np.linspace(0.0, drop_path_rate, sum(layers)), np.cumsum(layers)[:-1])
         for i in range(len(layers)):
             if outlook_attention[i]:
                 # stage 1
@@ -624,14 +808,16 @@ class VOLO(nn.Cell):
                                          kernel_size=out_kernel, stride=out_stride,
                                          padding=out_padding, mlp_ratio=mlp_ratios[i],
                                          qkv_bias=qkv_bias, qk_scale=qk_scale,
-                                         attn_drop=attn_drop_rate, norm_layer=norm_layer)
+                                         attn_drop=attn_drop_rate, norm_layer=norm_layer,
+                                         input_resolution=(resolution, resolution))
                 network.append(stage)
             else:
                 # stage 2
                 stage = transformer_blocks(Transformer, i, embed_dims[i], layers,
                                            num_heads[i], mlp_ratio=mlp_ratios[i],
                                            qkv_bias=qkv_bias, qk_scale=qk_scale,
-                                           drop_path_rate=drop_path_rate,
+                                           drop_path_rates=dpr[i].tolist(),
+                                           use_flash_attention=use_flash_attention,
                                            attn_drop=attn_drop_rate,
                                            norm_layer=norm_layer)
                 network.append(stage)
@@ -639,8 +825,11 @@ class VOLO(nn.Cell):
             if downsamples[i]:
                 # downsampling between two stages
                 network.append(Downsample(embed_dims[i], embed_dims[i + 1], 2))
+                resolution //= 2
 
         self.network = nn.CellList(network)
+        # positional encoding is added after the outlooker stage and its downsampling
+        self.pos_embed_idx = 2
 
         # set post block, for example, class attention layers
         self.post_network = None
@@ -654,7 +843,8 @@ class VOLO(nn.Cell):
                           qk_scale=qk_scale,
                           attn_drop=attn_drop_rate,
                           drop_path=0.0,
-                          norm_layer=norm_layer)
+                          norm_layer=norm_layer,
+                          use_flash_attention=use_flash_attention)
                 for i in range(len(post_layers))
             ])
             self.cls_token = Parameter(ops.zeros((1, 1, embed_dims[-1]), mstype.float32))
@@ -682,16 +872,43 @@ class VOLO(nn.Cell):
 
         self.pos_embed.set_data(init.initializer(init.TruncatedNormal(sigma=.02), self.pos_embed.data.shape))
         self._init_weights()
+        if dtype != mstype.float32:
+            self._set_block_dtype(dtype)
 
     def _init_weights(self) -> None:
-        for name, m in self.cells_and_names():
+        # Dense weights are grouped by shape so each group is sampled with a single NumPy draw
+        dense_weights = {}
+        for _, m in self.cells_and_names():
             if isinstance(m, nn.Dense):
-                m.weight.set_data(init.initializer(init.TruncatedNormal(sigma=.02), m.weight.data.shape))
+                dense_weights.setdefault(tuple(m.weight.shape), []).append(m.weight)
                 if m.bias is not None:
-                    m.bias.set_data(init.initializer(init.Constant(0), m.bias.shape))
+                    m.bias.set_data(init.initializer("zeros", m.bias.shape, m.bias.dtype))
             elif isinstance(m, nn.LayerNorm):
-                m.gamma.set_data(init.initializer(init.Constant(1), m.gamma.shape))
-                m.beta.set_data(init.initializer(init.Constant(0), m.beta.shape))
+                m.gamma.set_data(init.initializer("ones", m.gamma.shape, m.gamma.dtype))
+                m.beta.set_data(init.initializer("zeros", m.beta.shape, m.beta.dtype))
+        for shape, weights in dense_weights.items():
+            values = _trunc_normal((len(weights),) + shape, sigma=.02)
+            for weight, value in zip(weights, values):
+                weight.set_data(Tensor(value, weight.dtype))
+
+    def _set_block_dtype(self, dtype) -> None:
+        for _, cell in self.cells_and_names():
+            if isinstance(cell, (Outlooker, Transformer, ClassBlock)):
+                cell.attn.to_float(dtype)
+                cell.mlp.to_float(dtype)
+                cell.attn.softmax.to_float(mstype.float32)
+
+    def fold_attention_scale(self) -> None:
+        """Fold the constant attention scale into the q / attn projection weights of every attention layer,
+        removing one elementwise multiply per layer. Call it after the weights are loaded and before the network,
+        or any cell wrapping it, is first run: a graph compiled earlier keeps multiplying by the scale and would
+        apply it twice. Checkpoints saved afterwards hold the pre-scaled weights."""
+        if getattr(self, "compile_cache", None):
+            raise RuntimeError("fold_attention_scale() must be called before the network is compiled, "
+                               "the compiled graph would apply the attention scale twice.")
+        for _, cell in self.cells_and_names():
+            if isinstance(cell, (OutlookAttention, Attention, ClassAttention)):
+                cell.fold_scale()
 
     def forward_embeddings(self, x: Tensor) -> Tensor:
         # patch embedding
@@ -701,10 +918,10 @@ class VOLO(nn.Cell):
         return x
 
     def forward_tokens(self, x: Tensor) -> Tensor:
+        # the loop over the CellList is unrolled when compiled, so the index check is resolved at compile time
         for idx, block in enumerate(self.network):
-            if idx == 2:  # add positional encoding after outlooker blocks
-                x = x + self.pos_embed
-                x = self.pos_drop(x)
+            if idx == self.pos_embed_idx:
+                x = self.pos_drop(x + self.pos_embed)
             x = block(x)
 
         B, H, W, C = x.shape
@@ -714,10 +931,16 @@ class VOLO(nn.Cell):
     def forward_cls(self, x: Tensor) -> Tensor:
         # B, N, C = x.shape
         cls_tokens = ops.broadcast_to(self.cls_token, (x.shape[0], -1, -1))
-        x = ops.Cast()(x, cls_tokens.dtype)
+        if x.dtype != cls_tokens.dtype:
+            x = ops.cast(x, cls_tokens.dtype)
         x = ops.concat([cls_tokens, x], 1)
-        for block in self.post_network:
-            x = block(x)
+        last = len(self.post_network) - 1
+        for idx, block in enumerate(self.post_network):
+            if idx == last and not self.return_mean:
+                # only the class token feeds the head, so the feature tokens are not concatenated back
+                x = block.forward_cls_embed(x)
+            else:
+                x = block(x)
         return x
 
     def construct(self, x: Tensor) -> Tensor:
@@ -0,0 +1,58 @@
+import sys
+
+sys.path.append(".")
+
+import numpy as np
+import pytest
+
+import mindspore as ms
+from mindspore import Tensor, ops
+
+from mindcv.models.layers.drop_path import DropPath
+from mindcv.models.volo import Fold
+
+
+@pytest.mark.parametrize("scale_by_keep", [True, False])
+def test_drop_path(scale_by_keep):
+    ms.set_context(mode=ms.PYNATIVE_MODE)
+    drop_prob = 0.3
+    x = Tensor(np.ones((20000, 4, 2, 2)), ms.float32)
+    layer = DropPath(drop_prob, scale_by_keep=scale_by_keep)
+
+    layer.set_train(True)
+    y = layer(x).asnumpy()
+    kept = y.reshape(y.shape[0], -1)[:, 0] != 0
+    assert abs(kept.mean() - (1 - drop_prob)) < 0.02, "keep rate does not match 1 - drop_prob"
+    # the mask is shared by all elements of a sample
+    assert np.all((y == 0).all(axis=(1, 2, 3)) | (y != 0).all(axis=(1, 2, 3)))
+    expected = 1 / (1 - drop_prob) if scale_by_keep else 1.0
+    np.testing.assert_allclose(y[kept], expected, rtol=1e-6)
+
+    layer.set_train(False)
+    np.testing.assert_array_equal(layer(x).asnumpy(), x.asnumpy())
+
+
+def test_drop_path_seeded():
+    ms.set_context(mode=ms.PYNATIVE_MODE)
+    x = Tensor(np.ones((64, 8)), ms.float32)
+    outputs = []
+    for _ in range(2):
+        ms.set_seed(1)
+        layer = DropPath(0.5)
+        layer.set_train(True)
+        outputs.append(layer(x).asnumpy())
+    np.testing.assert_array_equal(outputs[0], outputs[1])
+
+
+@pytest.mark.skipif(not hasattr(ops, "fold"), reason="ops.fold is not available")
+def test_volo_fold_col2im():
+    ms.set_context(mode=ms.PYNATIVE_MODE)
+    b, c = 2, 4
+    x = Tensor(np.random.rand(b, c * 9, 14 * 14), ms.float32)
+    reference = Fold(c, 3, padding=1, stride=2, use_col2im=False)
+    fold = Fold(c, 3, padding=1, stride=2)
+    assert fold.use_col2im
+
+    y = fold(x, (28, 28))
+    assert y.shape == (b, c, 28, 28)
+    np.testing.assert_allclose(y.asnumpy(), reference(x, (28, 28)).asnumpy(), rtol=1e-5, atol=1e-5)
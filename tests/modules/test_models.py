@@ -151,6 +151,71 @@ def test_is_model_pretrained():
     assert num_pretrained > 0, "No pretrained models"
 
 
+def test_regnet_forward_from_stage():
+    import numpy as np
+
+    import mindspore as ms
+    from mindspore import Tensor
+
+    from mindcv.models.regnet import regnet_x_200mf
+
+    ms.set_context(mode=ms.PYNATIVE_MODE)
+    model = regnet_x_200mf(num_classes=10)
+    model.set_train(False)
+    param_names = [p.name for p in model.get_parameters()]
+
+    x = Tensor(np.random.rand(2, 3, 64, 64), dtype=ms.float32)
+    cached = model.stages[0](model.stem(x))
+    y = model.forward_from_stage(cached, 1)
+
+    np.testing.assert_allclose(y.asnumpy(), model(x).asnumpy(), rtol=1e-5, atol=1e-5)
+    assert [p.name for p in model.get_parameters()] == param_names, "forward_from_stage renamed parameters"
+
+
+def test_regnet_export_after_forward():
+    import numpy as np
+
+    import mindspore as ms
+    from mindspore import Tensor, ops
+
+    from mindcv.models.regnet import regnet_x_200mf
+
+    ms.set_context(mode=ms.PYNATIVE_MODE)
+    model = regnet_x_200mf(num_classes=10)
+    model.set_train(False)
+    x = Tensor(np.random.rand(2, 3, 64, 64), dtype=ms.float32)
+    model(x)
+
+    model.export_for_inference()
+    y = model(x).asnumpy()
+    # the exported cells must be the ones that run, not a graph cached before export
+    model.stem.conv.weight.set_data(ops.zeros_like(model.stem.conv.weight))
+    assert not np.allclose(model(x).asnumpy(), y), "forward did not pick up the exported cells"
+
+
+def test_regnet_export_for_inference():
+    import numpy as np
+
+    import mindspore as ms
+    from mindspore import Tensor, nn
+
+    from mindcv.models.regnet import RegNet
+
+    ms.set_context(mode=ms.PYNATIVE_MODE)
+    model = RegNet(36.44, 24, 2.49, 13, 8, head_w=64, num_classes=10)
+    model.set_train(False)
+    conv_names = [c.weight.name for _, c in model.cells_and_names() if isinstance(c, nn.Conv2d)]
+    x = Tensor(np.random.rand(2, 3, 64, 64), dtype=ms.float32)
+    y = model(x).asnumpy()
+
+    model.export_for_inference()
+    np.testing.assert_allclose(model(x).asnumpy(), y, rtol=1e-4, atol=1e-5)
+    assert not any(isinstance(c, nn.BatchNorm2d) for _, c in model.cells_and_names())
+    names = [p.name for p in model.get_parameters()]
+    assert len(names) == len(set(names)), "parameter names are not unique after export"
+    assert set(conv_names) <= set(names), "fused convs lost their parameter names"
+
+
 if __name__ == "__main__":
     #    test_model_forward("pnasnet")
     """